@@ -1,15 +1,20 @@
 """Removes exact or near duplicate images."""
 
-import cv2
+import os
 import tqdm
 import shutil
 import argparse
+import tempfile
 from enum import Enum
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 
 from imagededup import methods
 from imagededup.utils import plot_duplicates
 
+import image_hashing
+from utils import scandir_files
+
 class DedupMethod(Enum):
     """The method for duplicate removal."""
     CNN = 'cnn'
@@ -28,6 +33,12 @@ class DedupMethod(Enum):
             DedupMethod.AHASH: methods.AHash
         }[self]
 
+class LinkMode(Enum):
+    """How unique images are saved to the destination folder."""
+    COPY = 'copy'
+    HARDLINK = 'hardlink'
+    REFLINK = 'reflink'
+
 parser = argparse.ArgumentParser(description='Removes exact or near duplicae images.')
 parser.add_argument('source_directory', type=Path, help='The folder to search for duplicates.')
 parser.add_argument('destination_directory', type=Path, help='The folder to save all unique images.')
@@ -39,46 +50,164 @@ parser.add_argument('--min-similarity-threshold', type=float, default=0.9, help=
                     'an image as a duplicate (used for the CNN method).')
 parser.add_argument('--max-distance-threshold', type=float, default=8, help='The maximum hamming distance to consider'
                     'an image as a duplicate (used for hashing methods).')
+parser.add_argument('--no-hash-cache', action='store_false', dest='use_hash_cache',
+                    help='Don\'t cache perceptual hashes in the destination folder (used for the PHash method).')
+parser.add_argument('--link-mode', type=LinkMode, choices=list(LinkMode), default=LinkMode.COPY,
+                    help='How to save unique images to the destination folder. A hardlink or reflink avoids copying '
+                    'the file contents, and falls back to a copy if the source and destination are on different '
+                    'filesystems. Defaults to copying.')
 args = parser.parse_args()
 
+# The file extensions that are considered as images.
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.webp', '.bmp'}
+
+def is_image_file(filepath):
+    """Return whether the given file starts with the header of a supported image format."""
+    try:
+        with open(filepath, 'rb') as file:
+            header = file.read(12)
+    except OSError:
+        return False
+
+    return header.startswith(b'\xff\xd8\xff') or \
+        header.startswith(b'\x89PNG\r\n\x1a\n') or \
+        header.startswith(b'BM') or \
+        (header[:4] == b'RIFF' and header[8:12] == b'WEBP')
+
 def get_all_image_filepaths(directory):
-    """Return the filepath of every image in the given directory."""
-    images = []
-    directory = Path(directory)
-    for filename in directory.glob('**/*'):
-        # Check if OpenCV can read the image file,
-        # if it can, the file is an image.
-        image = cv2.imread(str(filename.absolute()))
-        if image is None: continue
-        images.append(filename)
-
-    return images
+    """Return the filepath of every image in the given directory (in sorted order)."""
+    # Filter by extension first, and then only read the file header
+    # to check that the file is actually an image.
+    filepaths = sorted(filepath for filepath in scandir_files(directory)
+        if os.path.splitext(filepath)[1].lower() in IMAGE_EXTENSIONS
+    )
+
+    # Reading the headers is I/O bound, so we can use many more threads than cores.
+    with ThreadPoolExecutor(max_workers=os.cpu_count() * 4) as executor:
+        is_image = list(executor.map(is_image_file, filepaths))
+
+    return [Path(filepath) for filepath, keep in zip(filepaths, is_image) if keep]
+
+def reflink_file(source, destination):
+    """
+    Copy a file with `os.copy_file_range`, which lets the kernel share the
+    underlying data (a reflink) on filesystems that support it.
+    """
+    with open(source, 'rb') as source_file, open(destination, 'wb') as destination_file:
+        remaining = os.fstat(source_file.fileno()).st_size
+        while remaining > 0:
+            copied = os.copy_file_range(source_file.fileno(), destination_file.fileno(), remaining)
+            if copied == 0: break
+            remaining -= copied
+
+def save_unique_image(source, destination, link_mode):
+    """
+    Save an image to the destination filepath using the given `LinkMode`.
+
+    The image is saved to a temporary file which then replaces the destination,
+    so an existing destination (which may be a hardlink to another image) is
+    never written through.
+    """
+    # The destination may already be the source (e.g. when saving to the source folder,
+    # or through a link to it), so there is nothing to save.
+    if os.path.exists(destination) and os.path.samefile(source, destination):
+        return
+
+    file, temporary = tempfile.mkstemp(dir=os.path.dirname(destination), prefix='.', suffix='.tmp')
+    os.close(file)
+    try:
+        try:
+            if link_mode == LinkMode.HARDLINK:
+                # Links can't be created over an existing file.
+                os.remove(temporary)
+                os.link(source, temporary)
+            elif link_mode == LinkMode.REFLINK and hasattr(os, 'copy_file_range'):
+                reflink_file(source, temporary)
+            else:
+                shutil.copyfile(source, temporary)
+        except OSError:
+            if link_mode == LinkMode.COPY: raise
+            # The source and destination are on different filesystems (or linking is
+            # not supported), so fall back to a regular copy.
+            shutil.copyfile(source, temporary)
+
+        os.replace(temporary, destination)
+    except BaseException:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+
+        raise
+
+def get_destination_filepaths(filepaths, directory):
+    """
+    Return the filepath in the given directory to save each image to.
+
+    Images that share a file name (in different subfolders) are given a numbered
+    suffix, in the order of `filepaths`, so that no two images are saved to the same file.
+    """
+    all_names = {filepath.name for filepath in filepaths}
+    used_names = set()
+
+    destinations = []
+    for filepath in filepaths:
+        name, counter = filepath.name, 1
+        # A renamed image must not take the name of another image either.
+        while name in used_names or (name != filepath.name and name in all_names):
+            name = f'{filepath.stem}_{counter}{filepath.suffix}'
+            counter += 1
+
+        used_names.add(name)
+        destinations.append(directory / name)
+
+    return destinations
 
 def main():
     """Main entrypoint when running this module from the terminal."""
-    method_class = args.method.get_method_class()
-    method = method_class()
+    args.destination_directory.mkdir(parents=True, exist_ok=True)
+    all_image_filepaths = get_all_image_filepaths(args.source_directory)
+    if args.method == DedupMethod.PHASH:
+        # Perceptual hashing is done in batches rather than through imagededup.
+        if args.use_hash_cache:
+            with image_hashing.PHashCache(args.destination_directory / '.phash_cache.sqlite') as cache:
+                filepaths, hashes = image_hashing.compute_phashes(all_image_filepaths, cache=cache)
+        else:
+            filepaths, hashes = image_hashing.compute_phashes(all_image_filepaths)
 
-    find_duplicates_kwargs = {}
-    if args.method == DedupMethod.CNN:
-        find_duplicates_kwargs['min_similarity_threshold'] = args.min_similarity_threshold
+        # Duplicates are identified by their full path, since images in different subfolders may share a name.
+        duplicates = {filepaths[i] for i in image_hashing.find_duplicates_to_remove(
+            hashes, args.max_distance_threshold
+        )}
     else:
-        find_duplicates_kwargs['max_distance_threshold'] = args.max_distance_threshold
+        method_class = args.method.get_method_class()
+        method = method_class()
+
+        find_duplicates_kwargs = {}
+        if args.method == DedupMethod.CNN:
+            find_duplicates_kwargs['min_similarity_threshold'] = args.min_similarity_threshold
+        else:
+            find_duplicates_kwargs['max_distance_threshold'] = args.max_distance_threshold
+
+        # imagededup only reports the file names of the duplicates.
+        duplicate_names = set(method.find_duplicates_to_remove(
+            image_dir=str(args.source_directory.absolute()),
+            **find_duplicates_kwargs
+        ))
 
-    duplicates = set(method.find_duplicates_to_remove(
-        image_dir=str(args.source_directory.absolute()),
-        **find_duplicates_kwargs
-    ))
+        duplicates = {filepath for filepath in all_image_filepaths if filepath.name in duplicate_names}
 
     # Copy non-duplicates to a new folder
     print(f'Copying non-duplicates to "{args.destination_directory}"')
 
-    args.destination_directory.mkdir(parents=True, exist_ok=True)
-    all_image_filepaths = get_all_image_filepaths(args.source_directory)
-    for image_filepath in tqdm.tqdm(all_image_filepaths):
-        if image_filepath.name in duplicates: continue
-        new_filepath = args.destination_directory / (image_filepath.name)
-        shutil.copyfile(image_filepath, new_filepath)
+    unique_image_filepaths = [filepath for filepath in all_image_filepaths if filepath not in duplicates]
+    destination_filepaths = get_destination_filepaths(unique_image_filepaths, args.destination_directory)
+    # Creating files is syscall bound, so it parallelizes well over threads.
+    with ThreadPoolExecutor(max_workers=os.cpu_count() * 4) as executor:
+        futures = [executor.submit(save_unique_image, filepath, destination, args.link_mode)
+            for filepath, destination in zip(unique_image_filepaths, destination_filepaths)
+        ]
+
+        for future in tqdm.tqdm(futures):
+            future.result()
 
     if args.summarise:
         total_duplicates = len(duplicates)
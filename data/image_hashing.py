@@ -0,0 +1,265 @@
+"""Batched perceptual hashing of images."""
+
+import os
+import cv2
+import sqlite3
+import numpy as np
+import scipy.fft
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from utils import get_md5_from_file, read_image
+
+# The size that images are resized to before computing the DCT.
+HASH_IMAGE_SIZE = 32
+# The size of the (low-frequency) block of DCT coefficients that make up the hash.
+HASH_SIZE = 8
+
+# Number of set bits in each byte value (used when numpy has no `bitwise_count`).
+_POPCOUNT_TABLE = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+def popcount(x):
+    """Return the number of set bits in each element of a uint64 array."""
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(x)
+
+    x = np.ascontiguousarray(x, dtype=np.uint64)
+    return _POPCOUNT_TABLE[x.view(np.uint8)].reshape(x.shape + (8,)).sum(axis=-1)
+
+def load_hash_image(filepath):
+    """
+    Load an image as a grayscale float32 array of size 32x32, ready for hashing.
+    Returns None if the image could not be loaded.
+    """
+    try:
+        image = read_image(filepath, cv2.IMREAD_GRAYSCALE)
+    except OSError:
+        return None
+
+    if image is None:
+        return None
+
+    image = cv2.resize(image, (HASH_IMAGE_SIZE, HASH_IMAGE_SIZE), interpolation=cv2.INTER_AREA)
+    return image.astype(np.float32)
+
+def phash_batch(images):
+    """
+    Compute the perceptual hash of a batch of images.
+
+    :param images:
+        A float32 array of shape (N, 32, 32) containing grayscale images.
+    :returns:
+        A uint64 array of shape (N,) containing the 64-bit hash of each image.
+    """
+    coefficients = scipy.fft.dctn(images, axes=(-2, -1), workers=-1)
+    coefficients = coefficients[:, :HASH_SIZE, :HASH_SIZE].reshape(len(images), -1)
+    # The DC coefficient is excluded from the median (the same as imagededup).
+    medians = np.median(coefficients[:, 1:], axis=-1, keepdims=True)
+    bits = coefficients >= medians
+    return np.packbits(bits, axis=-1).view(np.uint64).ravel()
+
+class PHashCache:
+    """
+    A persistent cache of perceptual hashes, stored in an SQLite database.
+
+    Hashes are looked up by filepath (valid as long as the modification time
+    and size of the file are unchanged), or by the MD5 hash of the file
+    contents, so that cached hashes survive files being moved or renamed.
+    """
+
+    def __init__(self, filepath, commit_interval=512):
+        """
+        Initialize the cache.
+
+        :param filepath:
+            The filepath of the SQLite database. It is created if it does not exist.
+        :param commit_interval:
+            The number of new hashes to add before committing them to the database.
+            Defaults to 512.
+        """
+        self._connection = sqlite3.connect(str(filepath))
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS phashes ('
+            'path TEXT PRIMARY KEY, mtime REAL, size INTEGER, md5 TEXT, hash BLOB)'
+        )
+        self._connection.execute('CREATE INDEX IF NOT EXISTS phashes_md5 ON phashes (md5)')
+        self._commit_interval = commit_interval
+        self._uncommitted = 0
+
+    def get(self, filepath):
+        """
+        Return the cached hash (as an int) of the given file, or None if it is not
+        cached under this filepath (or the file has changed since it was cached).
+        """
+        filepath = Path(filepath)
+        stat = filepath.stat()
+        row = self._connection.execute(
+            'SELECT hash FROM phashes WHERE path=? AND mtime=? AND size=?',
+            (str(filepath.absolute()), stat.st_mtime, stat.st_size)
+        ).fetchone()
+
+        return int.from_bytes(row[0], 'little') if row is not None else None
+
+    def get_by_md5(self, md5):
+        """Return the cached hash (as an int) of a file with the given MD5 hash, or None if there is none."""
+        row = self._connection.execute('SELECT hash FROM phashes WHERE md5=? LIMIT 1', (md5,)).fetchone()
+        return int.from_bytes(row[0], 'little') if row is not None else None
+
+    def put(self, filepath, value, md5=None):
+        """
+        Add the hash (an int) of the given file to the cache.
+        The MD5 hash of the file is computed if it is not given.
+        """
+        filepath = Path(filepath)
+        stat = filepath.stat()
+        if md5 is None:
+            md5 = get_md5_from_file(filepath)
+
+        self._connection.execute(
+            'INSERT OR REPLACE INTO phashes (path, mtime, size, md5, hash) VALUES (?, ?, ?, ?, ?)',
+            (str(filepath.absolute()), stat.st_mtime, stat.st_size, md5, int(value).to_bytes(8, 'little'))
+        )
+
+        self._uncommitted += 1
+        if self._uncommitted >= self._commit_interval:
+            self.commit()
+
+    def commit(self):
+        """Commit all new hashes to the database."""
+        self._connection.commit()
+        self._uncommitted = 0
+
+    def close(self):
+        """Commit all new hashes and close the database."""
+        self.commit()
+        self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def compute_phashes(filepaths, batch_size=4096, cache=None):
+    """
+    Compute the perceptual hash of every image in the given list of filepaths.
+
+    :param filepaths:
+        A list of image filepaths.
+    :param batch_size:
+        The number of images to hash at a time. Defaults to 4096.
+    :param cache:
+        A `PHashCache` to look up hashes in and add new hashes to.
+        Defaults to None, meaning that every image is hashed.
+    :returns:
+        A list of the filepaths that could be loaded, and a uint64 array
+        containing the hash of each of those images (in the same order).
+    """
+    hashes = [None] * len(filepaths)
+    if cache is not None:
+        for i, filepath in enumerate(filepaths):
+            hashes[i] = cache.get(filepath)
+
+    uncached_indices = [i for i, value in enumerate(hashes) if value is None]
+    uncached_hashes, md5s = _compute_phashes([filepaths[i] for i in uncached_indices], batch_size, cache)
+    for i, value, md5 in zip(uncached_indices, uncached_hashes, md5s):
+        hashes[i] = value
+        if cache is not None and value is not None:
+            cache.put(filepaths[i], value, md5=md5)
+
+    indices = [i for i, value in enumerate(hashes) if value is not None]
+    return [filepaths[i] for i in indices], np.array([hashes[i] for i in indices], dtype=np.uint64)
+
+def _compute_phashes(filepaths, batch_size, cache=None):
+    """
+    Compute the perceptual hash of every image in the given list of filepaths.
+    If a `PHashCache` is given, the MD5 hash of each file is computed alongside
+    loading the image, and used to look up hashes of files that have moved.
+
+    Returns a list containing the hash (as an int) of each image, or None if
+    the image could not be loaded, and a list containing the MD5 hash of each
+    file (or None if no cache was given).
+    """
+    hashes, md5s, batch, batch_indices = [None] * len(filepaths), [None] * len(filepaths), [], []
+    def hash_batch():
+        for i, value in zip(batch_indices, phash_batch(np.stack(batch)).tolist()):
+            hashes[i] = value
+
+        batch.clear()
+        batch_indices.clear()
+
+    def load(filepath):
+        """Load an image for hashing, and compute the MD5 hash of the file if there is a cache."""
+        md5 = get_md5_from_file(Path(filepath)) if cache is not None else None
+        return load_hash_image(filepath), md5
+
+    # Decoding, resizing, and hashing files releases the GIL, so it parallelizes over threads.
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        for i, (image, md5) in enumerate(executor.map(load, filepaths)):
+            if image is None: continue
+            md5s[i] = md5
+
+            # The file may have been hashed under a different path.
+            if md5 is not None:
+                hashes[i] = cache.get_by_md5(md5)
+                if hashes[i] is not None: continue
+
+            batch.append(image)
+            batch_indices.append(i)
+
+            if len(batch) == batch_size:
+                hash_batch()
+
+    if len(batch) > 0:
+        hash_batch()
+
+    return hashes, md5s
+
+def find_duplicate_pairs(hashes, max_distance_threshold):
+    """
+    Find all pairs of hashes within the given hamming distance of each other.
+
+    :param hashes:
+        A uint64 array containing the hash of each image.
+    :param max_distance_threshold:
+        The maximum hamming distance to consider an image as a duplicate.
+    :returns:
+        A generator of (i, j) index pairs where i < j.
+    """
+    n = len(hashes)
+    # Compute the distance matrix a block of rows at a time to bound memory usage.
+    block_size = max(1, (1 << 22) // max(n, 1))
+    for start in range(0, n, block_size):
+        block = hashes[start:start + block_size]
+        distances = popcount(np.bitwise_xor(block[:, None], hashes[None, :]))
+        rows, columns = np.nonzero(distances <= max_distance_threshold)
+        rows += start
+        for i, j in zip(rows.tolist(), columns.tolist()):
+            if i < j: yield i, j
+
+def find_duplicates_to_remove(hashes, max_distance_threshold):
+    """
+    Group images that are within the given hamming distance of each other,
+    and find the images that should be removed so that only the first image
+    of each group remains.
+
+    :param hashes:
+        A uint64 array containing the hash of each image.
+    :param max_distance_threshold:
+        The maximum hamming distance to consider an image as a duplicate.
+    :returns:
+        A set containing the indices of the images to remove.
+    """
+    # Union-find over the images, where each set is rooted at its lowest index.
+    parents = list(range(len(hashes)))
+    def find(i):
+        while parents[i] != i:
+            parents[i] = parents[parents[i]]
+            i = parents[i]
+        return i
+
+    for i, j in find_duplicate_pairs(hashes, max_distance_threshold):
+        root_i, root_j = find(i), find(j)
+        if root_i != root_j:
+            parents[max(root_i, root_j)] = min(root_i, root_j)
+
+    return {i for i in range(len(hashes)) if find(i) != i}
@@ -4,12 +4,184 @@ import os
 import time
 import tqdm
 import click
+import queue
 import argparse
-from PIL import Image
+import threading
+import functools
+import numpy as np
+from PIL import Image, ImageColor
 from pathlib import Path
 from face_detection import FaceDetector
 from u2net_wrapper import U2Net, InvalidImageError
-from utils import ReadableDirectory, rmtree, get_files
+from utils import ReadableDirectory, rmtree, get_files, read_image
+from concurrent.futures import Future, ThreadPoolExecutor
+
+def remove_transparency(image, colour):
+    """
+    Replace the transparency in an image with a solid colour.
+
+    :param image:
+        A PIL image.
+    :param colour:
+        A tuple containing the red, green, and blue components of the colour.
+    :returns:
+        An RGB PIL image.
+    """
+
+    rgba = np.asarray(image.convert('RGBA'), dtype=np.uint16)
+    alpha = rgba[..., 3:]
+    # Alpha blend in 16-bit fixed point (the largest value is 255 * 255).
+    blended = rgba[..., :3] * alpha + np.array(colour, dtype=np.uint16) * (255 - alpha)
+    # Divide by 255 (rounding to the nearest integer) without a division.
+    blended += 128
+    rgb = (blended + (blended >> 8)) >> 8
+    return Image.fromarray(rgb.astype(np.uint8), 'RGB')
+
+def estimate_foreground_fraction(segmentation_map):
+    """Estimate the fraction of an image that was segmented as foreground by U2Net."""
+
+    mask = np.asarray(segmentation_map, dtype=np.float32)
+    # The map may either be normalized to [0, 1] or stored as 8-bit values.
+    threshold = 127.5 if mask.max() > 1 else 0.5
+    return float(np.mean(mask > threshold))
+
+def segment_images(u2net, files, min_foreground_fraction=0.0, max_foreground_fraction=1.0):
+    """
+    Segment a list of images and remove their backgrounds using U2Net
+    (one image at a time, since the U2Net wrapper only takes single filepaths).
+
+    :param u2net:
+        The `U2Net` model.
+    :param files:
+        A list of image filepaths.
+    :param min_foreground_fraction:
+        The minimum fraction of the image that must be foreground. Defaults to 0.
+    :param max_foreground_fraction:
+        The maximum fraction of the image that can be foreground. Defaults to 1.
+    :returns:
+        A list containing a (segmentation map, image without background) tuple
+        for each file, or None if the file is not a valid image or its foreground
+        fraction is out of range.
+    """
+
+    results = []
+    for file in files:
+        segmentation_map = u2net.segment_image(file)
+
+        # Skip background removal for images that will be discarded anyway
+        # (i.e. when the segmentation found almost nothing, or almost everything).
+        foreground_fraction = estimate_foreground_fraction(segmentation_map)
+        if not min_foreground_fraction <= foreground_fraction <= max_foreground_fraction:
+            results.append(None)
+            continue
+
+        try:
+            image = u2net.remove_background(file, segmentation_map)
+        except InvalidImageError:
+            image = None
+
+        results.append((segmentation_map, image) if image is not None else None)
+
+    return results
+
+def save_sample(args, u2net, bg_colour, sample):
+    """
+    Crop and filter a processed image, and save it to the destination dataset.
+
+    :param args:
+        The parsed command line arguments.
+    :param u2net:
+        The `U2Net` model.
+    :param bg_colour:
+        The colour to replace transparency with.
+    :param sample:
+        A tuple containing the filepath, the `FaceDetectionResult`, the U2Net
+        segmentation map, and the image without background.
+    """
+
+    file, face_detection_result, segmentation_map, image = sample
+
+    # Crop image to bounding box (using U2Net)
+    bounding_box = u2net.get_bounding_box(segmentation_map)
+    image = image.crop(bounding_box)
+
+    # Tuple of the form (x1, y1, x2, y2)
+    fbb = face_detection_result.bounding_box
+    fbb_width = (fbb[2] - fbb[0])
+    fbb_height = (fbb[3] - fbb[1])
+
+    image_width, image_height = image.size
+    # Compute the face-to-image area ratio.
+    # This is used as a heuristic to filter out portrait images
+    # (i.e. when the face takes up more than a certain percentage of the total image).
+    face_image_ratio = (fbb_width * fbb_height) / (image_width * image_height)
+    if face_image_ratio > args.face_image_ratio_threshold:
+        return
+
+    if args.crop_faces:
+        # Crop out the face...
+        # This assumes that the image is of a person standing vertically.
+
+        # Convert the bottom-right y-coordinate of the face bounding box
+        # into the coordinate system AFTER cropping.
+        adjusted_fbb_y2 = fbb[3] - bounding_box[1]
+        image = image.crop((0, adjusted_fbb_y2 - fbb_height * 0.10, image_width, image_height))
+
+    if args.remove_transparency:
+        # Replace transparency with colour
+        image = remove_transparency(image, bg_colour)
+
+    # Output processed image
+    destination = args.dataset_destination / (file.stem + '.png')
+    image.save(str(destination))
+
+def load_batches(files, batch_size, load_queue, stop_event):
+    """
+    Load batches of images (for face detection) and put them on the queue,
+    followed by None once all the files have been loaded (or `stop_event` is set).
+    """
+
+    try:
+        # OpenCV releases the GIL while decoding, so images are decoded over multiple threads.
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            for batch_start in range(0, len(files), batch_size):
+                # Stop early if another stage of the pipeline has failed.
+                if stop_event.is_set(): break
+
+                batch = files[batch_start:batch_start + batch_size]
+                load_queue.put((batch, list(executor.map(read_image, batch))))
+    finally:
+        load_queue.put(None)
+
+def consume_queue(source_queue, callback, stop_event):
+    """
+    Call the callback with every item on the queue until None is received.
+    If the callback raises, `stop_event` is set so that the producer can stop early.
+    """
+
+    try:
+        for item in iter(source_queue.get, None):
+            callback(item)
+    except BaseException:
+        stop_event.set()
+        # Keep draining the queue so that the producer doesn't block.
+        for _ in iter(source_queue.get, None):
+            pass
+
+        raise
+
+def start_thread(target, *args):
+    """Run the target function in a daemon thread. Returns a `Future` for its result."""
+
+    future = Future()
+    def run():
+        try:
+            future.set_result(target(*args))
+        except BaseException as exception:
+            future.set_exception(exception)
+
+    threading.Thread(target=run, daemon=True).start()
+    return future
 
 def main():
     """Main entrypoint when running this module from the terminal."""
@@ -26,7 +198,15 @@ def main():
     parser.add_argument('--bg-colour', type=str, default='WHITE', help='The colour to replace transparency with.')
     parser.add_argument('--u2net-size', type=str, default='large', help='The size of the pretrained U-2-net model. Either \'large\' or \'small\'.')
     parser.add_argument('--face_image_ratio_threshold', type=float, default=0.05, help='The maximum face-to-image area ratio that is allowed.')
+    parser.add_argument('--min-foreground-fraction', type=float, default=0.05, help='The minimum fraction of the image '
+                        'that U2Net must segment as foreground.')
+    parser.add_argument('--max-foreground-fraction', type=float, default=0.95, help='The maximum fraction of the image '
+                        'that U2Net can segment as foreground.')
     parser.add_argument('--crop-faces', dest='crop_faces', action='store_true', help='Crop out faces.')
+    parser.add_argument('--batch-size', type=int, default=16, help='The number of images to run through the models at a time.')
+    parser.add_argument('--no-cuda', action='store_true', help='Run face detection on the CPU even if a CUDA-enabled '
+                        'device is available.')
+    parser.add_argument('--fp16', action='store_true', help='Run face detection in half precision (only applies when using CUDA).')
     parser.add_argument('--yes', '-y', action='store_true', help='Yes to all.')
     args = parser.parse_args()
 
@@ -42,67 +222,67 @@ def main():
                 abort=True
             )
 
-        _rmtree(args.dataset_destination)
+        rmtree(args.dataset_destination)
 
     args.dataset_destination.mkdir(exist_ok=True, parents=True)
+    bg_colour = ImageColor.getrgb(args.bg_colour)[:3]
 
     u2net = U2Net(pretrained_model_name=args.u2net_size)
-    face_detector = FaceDetector()
-
-    files = list(get_files(args.dataset_source, args.file_glob_patterns))
-    with tqdm.tqdm(files) as progress:
-        for file in progress:
-            progress.set_description(f'Processing {file.name}')
-
-            # Skip images that don't have a single face in them...
-            face_detection_results = face_detector.detect_faces(file)
-            if len(face_detection_results) != 1:
-                continue
-
-            segmentation_map = u2net.segment_image(file)
-
-            try:
-                # Remove background from image (using U2Net)
-                image = u2net.remove_background(file, segmentation_map)
-                old_image_width, old_image_height = image.size
-            except InvalidImageError as e:
-                continue
-
-            # Crop image to bounding box (using U2Net)
-            bounding_box = u2net.get_bounding_box(segmentation_map)
-            image = image.crop(bounding_box)
-
-            # Tuple of the form (x1, y1, x2, y2)
-            fbb = face_detection_results[0].bounding_box
-            fbb_width = (fbb[2] - fbb[0])
-            fbb_height = (fbb[3] - fbb[1])
-
-            image_width, image_height = image.size
-            # Compute the face-to-image area ratio.
-            # This is used as a heuristic to filter out portrait images
-            # (i.e. when the face takes up more than a certain percentage of the total image).
-            face_image_ratio = (fbb_width * fbb_height) / (image_width * image_height)
-            if face_image_ratio > args.face_image_ratio_threshold:
-                continue
-
-            if args.crop_faces:
-                # Crop out the face...
-                # This assumes that the image is of a person standing vertically.
-
-                # Convert the bottom-right y-coordinate of the face bounding box
-                # into the coordinate system AFTER cropping.
-                adjusted_fbb_y2 = fbb[3] - bounding_box[1]
-                image = image.crop((0, adjusted_fbb_y2 - fbb_height * 0.10, image_width, image_height))
-
-            if args.remove_transparency:
-                # Replace transparency with colour
-                background_image = Image.new('RGBA', image.size, args.bg_colour)
-                background_image.paste(image, (0, 0), image)
-                image = background_image.convert('RGB')
-
-            # Output processed image
-            destination = args.dataset_destination / (file.stem + '.png')
-            image.save(str(destination))
+    face_detector = FaceDetector(use_cuda=False if args.no_cuda else None, fp16=args.fp16)
+
+    # Walk the source directory once, in a deterministic order.
+    files = sorted(get_files(args.dataset_source, args.file_glob_patterns))
+
+    # The pipeline is split into three stages that run concurrently: loading images
+    # from disk, running the models (on this thread), and cropping and saving images.
+    load_queue = queue.Queue(maxsize=2)
+    save_queue = queue.Queue(maxsize=32)
+    # Set to stop the pipeline early (e.g. when a stage fails).
+    stop_event = threading.Event()
+    loader = start_thread(load_batches, files, args.batch_size, load_queue, stop_event)
+    saver = start_thread(consume_queue, save_queue, functools.partial(save_sample, args, u2net, bg_colour), stop_event)
+
+    batches = iter(load_queue.get, None)
+    try:
+        with tqdm.tqdm(total=len(files)) as progress:
+            for batch, images in batches:
+                # Saving failed, so stop running the models (the error is raised below).
+                if stop_event.is_set(): break
+
+                progress.set_description(f'Processing {batch[0].name}')
+
+                # Run face detection over the whole batch with a single forward pass.
+                batch_face_detection_results = face_detector.detect_faces_in_images(images)
+
+                # Skip images that don't have a single face in them...
+                single_face_batch = [(file, face_detection_results[0])
+                    for file, face_detection_results in zip(batch, batch_face_detection_results)
+                    if len(face_detection_results) == 1
+                ]
+
+                # Remove background from images (using U2Net)
+                segmentation_results = segment_images(
+                    u2net, [file for file, _ in single_face_batch],
+                    min_foreground_fraction=args.min_foreground_fraction,
+                    max_foreground_fraction=args.max_foreground_fraction
+                )
+
+                for (file, face_detection_result), segmentation_result in zip(single_face_batch, segmentation_results):
+                    if segmentation_result is None: continue
+                    save_queue.put((file, face_detection_result, *segmentation_result))
+
+                progress.update(len(batch))
+    finally:
+        # Stop the loader (if it hasn't finished), and drain the load queue so that it isn't blocked on it.
+        stop_event.set()
+        for _ in batches:
+            pass
+
+        save_queue.put(None)
+
+    # Wait for the remaining images to be saved (and raise any errors from the other stages).
+    saver.result()
+    loader.result()
 
 if __name__ == '__main__':
     main()
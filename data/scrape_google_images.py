@@ -3,15 +3,19 @@
 import time
 import uuid
 import json
+import shutil
 import argparse
 import requests
 from pathlib import Path
 from selenium import webdriver
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
 
 parser = argparse.ArgumentParser()
 parser.add_argument('query', type=str, help='The search query to scrape.')
 parser.add_argument('output_directory', type=str, help='The directory to output scraped images')
 parser.add_argument('--max-images', type=int, default=1000, help='The maximum number of images to scrape.')
+parser.add_argument('--download-workers', type=int, default=16, help='The number of images to download at a time.')
 args = parser.parse_args()
 
 BASE_URL = 'https://www.google.com/search?q={0}&source=lnms&tbm=isch'
@@ -20,6 +24,22 @@ SLEEP_TIME = 0.1
 output_directory = Path(args.output_directory)
 output_directory.mkdir(parents=True, exist_ok=True)
 
+# Share a connection pool between all downloads so that connections are kept alive.
+session = requests.Session()
+adapter = HTTPAdapter(pool_connections=32, pool_maxsize=32)
+session.mount('http://', adapter)
+session.mount('https://', adapter)
+
+def download_image(src, filepath):
+    """Download the image at the given URL and save it to the given filepath."""
+    with session.get(src, stream=True, timeout=5) as response:
+        response.raw.decode_content = True
+        with open(filepath, 'wb+') as file:
+            shutil.copyfileobj(response.raw, file)
+
+# Images are downloaded in the background so that scraping doesn't wait on the network.
+downloader = ThreadPoolExecutor(max_workers=args.download_workers)
+
 browser_instance = webdriver.Firefox()
 browser_instance.get(BASE_URL.format(args.query))
 
@@ -42,13 +62,12 @@ while len(links) < args.max_images:
                     links.add(src)
 
                     filepath = output_directory / '{}_{}.png'.format(args.query, uuid.uuid4())
-                    with open(filepath, 'wb+') as file:
-                        response = requests.get(src, stream=True)
-                        for chunk in response.iter_content(32768):
-                            if not chunk: break
-                            file.write(chunk)
+                    downloader.submit(download_image, src, filepath)
         except:
             continue
 
         if len(links) >= args.max_images: break
-    offset_index = len(thumbnails)
\ No newline at end of file
+    offset_index = len(thumbnails)
+
+# Wait for the remaining downloads to finish
+downloader.shutdown(wait=True)
\ No newline at end of file
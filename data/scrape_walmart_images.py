@@ -1,13 +1,23 @@
 """Scrape product images from Walmart."""
 
+import re
+import time
 import uuid
+import itertools
 import tqdm
+import asyncio
+import aiohttp
 import requests
 import argparse
 import mimetypes
 from enum import Enum
+from json import dumps
+from functools import lru_cache
 from pathlib import Path
 from bs4 import BeautifulSoup
+from urllib3.util.retry import Retry
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import (
     urlencode,
     unquote,
@@ -29,7 +39,8 @@ parser.add_argument('--sources', type=WalmartSource, nargs='+', choices=list(Wal
                     WalmartSource.WALMART_CA, WalmartSource.WALMART_COM],
                     help='The source to scrape images from (i.e. the Walmart site(s)). Defaults to '
                     'Canadian Walmart (https://walmart.ca) and American Walmart (https://walmart.com).')
-parser.add_argument('--chunk-size', '-cz', type=int, default=32768, help='The number of bytes to save at a time.')
+parser.add_argument('--chunk-size', '-cz', type=int, default=131072, help='The number of bytes to save at a time.')
+parser.add_argument('--max-concurrent-downloads', type=int, default=64, help='The maximum number of images to download at a time.')
 parser.add_argument
 args = parser.parse_args()
 
@@ -48,6 +59,11 @@ def add_url_params(url, **params):
     >> add_url_params(url, **new_params)
     'http://stackoverflow.com/test?data=some&data=values&answers=false'
     """
+    # Fast path: without existing args or values that need converting,
+    # there is nothing to merge, so the params can be appended directly.
+    if '?' not in url and not any(isinstance(v, (bool, dict)) for v in params.values()):
+        return url + '?' + urlencode(params, doseq=True, quote_via=urlquote)
+
     # Unquoting URL first so we don't loose existing args
     url = unquote(url)
     # Extracting url info
@@ -81,20 +97,55 @@ def add_url_params(url, **params):
 
     return new_url
 
+# Patterns for extracting the page numbers from the pagination of a search page.
+# The classes are matched as tokens, since they may not be the only ones (or the first attribute).
+_PAGE_CA_RE = re.compile(rb'<span[^>]*class="(?:[^"]*\s)?css-ijjviy ed60zyg11(?:\s[^"]*)?"[^>]*>(\d+)<')
+_PAGINATOR_COM_RE = re.compile(rb'<ul[^>]*class="(?:[^"]*\s)?paginator-list(?:\s[^"]*)?"[^>]*>(.*?)</ul>', re.DOTALL)
+_PAGE_LINK_COM_RE = re.compile(rb'<a[^>]*>\s*(\d+)\s*</a>')
+
+# Selectors for the product images on a search page (matched in a single pass over the tree).
+_PRODUCT_IMAGE_CA_SELECTOR = 'div.css-x7wixz.epettpn0[data-automation=product] img.css-gxbcya.e175iya62'
+_PRODUCT_IMAGE_COM_SELECTOR = 'img[data-pnodetype=item-pimg]'
+
+# Emulate Gecko agent
+USER_AGENT = 'Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:52.0) Gecko/20100101 Firefox/52.0'
+DEFAULT_HEADERS = {
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Methods': 'GET',
+    'Access-Control-Allow-Headers': 'Content-Type',
+    'Access-Control-Max-Age': '3600',
+    'User-Agent': USER_AGENT
+}
+
+# The number of seconds to wait for the server before giving up on a page request.
+REQUEST_TIMEOUT = 10
+
+# The number of times to fetch a Walmart.com search page when it is missing the pagination or products,
+# and the number of seconds to wait before the first retry (doubled after each retry).
+PAGE_RETRIES = 5
+PAGE_RETRY_DELAY = 0.5
+
+# A single session is shared by all page requests so that connections
+# (and their TLS handshakes) are reused across pages.
+SESSION = requests.Session()
+SESSION.headers.update(DEFAULT_HEADERS)
+SESSION.mount('https://', HTTPAdapter(
+    pool_connections=32,
+    pool_maxsize=64,
+    max_retries=Retry(total=3, backoff_factor=0.3)
+))
+
+def get_page(url, **params):
+    """Return the content of the page given a url and parameters."""
+    request = SESSION.get(add_url_params(url, **params), timeout=REQUEST_TIMEOUT)
+    return request.content
+
 def get_bs4(url, **params):
     """Return the BeautifulSoup instance given a url and parameters."""
-    DEFAULT_HEADERS = {
-        'Access-Control-Allow-Origin': '*',
-        'Access-Control-Allow-Methods': 'GET',
-        'Access-Control-Allow-Headers': 'Content-Type',
-        'Access-Control-Max-Age': '3600',
-        # Emulate Gecko agent
-        'User-Agent': 'Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:52.0) Gecko/20100101 Firefox/52.0'
-    }
-
-    request = requests.get(add_url_params(url, **params), DEFAULT_HEADERS)
-    return BeautifulSoup(request.content, 'html.parser')
+    return BeautifulSoup(get_page(url, **params), 'lxml')
 
+# The same product often shows up on multiple pages (e.g. sponsored and organic results).
+@lru_cache(maxsize=8192)
 def get_walmart_image(image_url):
     """
     Return the original image URL from a Walmart thumbnail image URL.
@@ -118,88 +169,188 @@ def get_walmart_image(image_url):
     return None
 
 def scrape_walmart_ca():
-    """Scrape from Walmart.ca."""
+    """Scrape from Walmart.ca. Yields the URL of each image as soon as it is found."""
     ROOT_URL = 'https://www.walmart.ca/search'
 
-    # Get max page
-    max_page = None
-    soup = get_bs4(ROOT_URL, q=args.query)
-    pages = [int(span.text)
-        for span in soup.findAll('span', {'class': 'css-ijjviy ed60zyg11'})
-        if span.text.isnumeric()
-    ]
-
-    if len(pages) > 0:
-        max_page = max(pages)
+    # Get max page (the pagination is matched on the raw HTML, without building a tree).
+    first_page = get_page(ROOT_URL, q=args.query, p=1)
+    max_page = max(map(int, _PAGE_CA_RE.findall(first_page)), default=None)
 
-    result = set()
+    # The raw thumbnail URLs that have already been seen, so that duplicates are skipped early.
+    seen_sources = set()
     with tqdm.tqdm(total=max_page) as progress:
         while max_page is None or progress.n < max_page:
             page = progress.n + 1
-            soup = get_bs4(ROOT_URL, q=args.query, p=page)
-            products = soup.findAll('div', {
-                'class': 'css-x7wixz epettpn0',
-                'data-automation': 'product'
-            })
+            if page == 1:
+                soup = BeautifulSoup(first_page, 'lxml')
+            else:
+                soup = get_bs4(ROOT_URL, q=args.query, p=page)
 
-            if len(products) == 0:
+            images = soup.select(_PRODUCT_IMAGE_CA_SELECTOR)
+            if len(images) == 0:
                 break
 
-            for product in products:
-                image = product.find('img', {'class': 'css-gxbcya e175iya62'})
-                image_url = get_walmart_image(image['src'])
+            for image in images:
+                source = image.get('src')
+                if source is None or source in seen_sources: continue
+                seen_sources.add(source)
+
+                image_url = get_walmart_image(source)
                 if image_url is None: continue
-                result.add(image_url)
+                yield image_url
 
             progress.update(1)
 
-    return result
-
 def scrape_walmart_com():
-    """Scrape from Walmart.com."""
+    """Scrape from Walmart.com. Yields the URL of each image as soon as it is found."""
     ROOT_URL = 'https://www.walmart.com/search/'
 
-    # Get max page
-    while True:
-        max_page = None
-        soup = get_bs4(ROOT_URL, query=args.query, page=1, ps=40)
-        paginator_list = soup.find('ul', {'class': 'paginator-list'})
-        if paginator_list is None: continue
-
-        pages = [int(a.text)
-            for a in [li.find('a') for li in paginator_list.findAll('li')]
-            if a is not None and a.text.isnumeric()
-        ]
+    # Get max page (the pagination is matched on the raw HTML, without building a tree).
+    # If the pagination is never found, the pages are scraped until one has no product images.
+    max_page = None
+    for attempt in range(PAGE_RETRIES):
+        if attempt > 0: time.sleep(PAGE_RETRY_DELAY * 2 ** (attempt - 1))
 
-        if len(pages) > 0:
-            max_page = max(pages)
+        first_page = get_page(ROOT_URL, query=args.query, page=1, ps=40)
+        paginator_list = _PAGINATOR_COM_RE.search(first_page)
+        if paginator_list is None: continue
 
+        max_page = max(map(int, _PAGE_LINK_COM_RE.findall(paginator_list.group(1))), default=None)
         break
 
-    result = set()
-    with tqdm.tqdm(total=max_page) as progress:
-        while max_page is None or progress.n < max_page:
-            page = progress.n + 1
-            while True:
+    def get_page_image_sources(page):
+        """
+        Return the raw thumbnail URL of every product image on a search page
+        (retrying a few times if the page has no images).
+        """
+        # Reuse the first page rather than fetching it again.
+        content = first_page if page == 1 else None
+        for attempt in range(PAGE_RETRIES):
+            if attempt > 0: time.sleep(PAGE_RETRY_DELAY * 2 ** (attempt - 1))
+
+            if content is not None:
+                soup = BeautifulSoup(content, 'lxml')
+                # Fetch the page again if we have to retry.
+                content = None
+            else:
                 soup = get_bs4(ROOT_URL, query=args.query, page=page, ps=40)
-                images = soup.findAll('img', {
-                    'data-pnodetype': 'item-pimg'
-                })
 
-                if len(images) > 0: break
-                if len(images) == 0 and max_page is None:
-                    progress.n = max_page
-                    break
+            images = soup.select(_PRODUCT_IMAGE_COM_SELECTOR)
 
-            for image in images:
-                image_url = get_walmart_image(image['src'])
+            # Without a max page, an empty page means that there are no more results.
+            if len(images) > 0 or max_page is None:
+                return [image.get('src') for image in images]
+
+        # The page never had any images, so treat it as empty.
+        return []
+
+    # The raw thumbnail URLs that have already been seen (on any page), so that duplicates are skipped early.
+    # Pages are deduplicated here, in page order, so that duplicates don't affect when pagination stops.
+    seen_sources = set()
+    with ThreadPoolExecutor(max_workers=8) as executor, tqdm.tqdm(total=max_page) as progress:
+        if max_page is None:
+            # We can only go through the pages one at a time until we reach one without any product images.
+            pages = itertools.takewhile(len, map(get_page_image_sources, itertools.count(1)))
+        else:
+            # The pages are independent once we know how many there are, so fetch them concurrently.
+            pages = executor.map(get_page_image_sources, range(1, max_page + 1))
+
+        for sources in pages:
+            for source in sources:
+                if source is None or source in seen_sources: continue
+                seen_sources.add(source)
+
+                image_url = get_walmart_image(source)
                 if image_url is None: continue
-                result.add(image_url)
+                yield image_url
 
             progress.update(1)
 
-    return result
+# Map each content type to its file extension (almost every image is a JPEG).
+_EXTENSION_CACHE = {}
+def get_extension(content_type):
+    """
+    Return the file extension for a content type, defaulting to '.jpg'
+    for content types that aren't images (or have no known extension).
+    """
+    extension = _EXTENSION_CACHE.get(content_type)
+    if extension is None:
+        # A missing content type is reported as 'application/octet-stream'.
+        if content_type.startswith('image/'):
+            extension = mimetypes.guess_extension(content_type)
+
+        extension = extension or '.jpg'
+        _EXTENSION_CACHE[content_type] = extension
 
+    return extension
+
+# Images are named with a random prefix (unique to this run) and a counter,
+# rather than generating a new UUID for every image.
+_FILENAME_PREFIX = uuid.uuid4().hex
+_FILENAME_COUNTER = itertools.count()
+_OUTPUT_DIRECTORY = str(args.output_directory)
+
+def write_file(filepath, data):
+    """Write data to a file with a single call."""
+    with open(filepath, 'wb') as file:
+        file.write(data)
+
+async def download_image(session, writer, url):
+    """
+    Download an image and save it to the output directory.
+    The image is written on the given writer executor, so that the
+    event loop can keep reading from the sockets in the meantime.
+    """
+    loop = asyncio.get_running_loop()
+    async with session.get(url) as response:
+        # Don't save error pages (these count as failed downloads).
+        response.raise_for_status()
+
+        extension = get_extension(response.content_type)
+        filepath = f'{_OUTPUT_DIRECTORY}/{_FILENAME_PREFIX}_{next(_FILENAME_COUNTER)}{extension}'
+        # Most product images fit in a single chunk, so just read the whole body and write it with a single call.
+        if response.content_length is not None and response.content_length <= args.chunk_size:
+            data = await response.read()
+            await loop.run_in_executor(writer, write_file, filepath, data)
+            return
+
+        # Otherwise, the image is streamed to disk a chunk at a time (rather than being held in memory).
+        file = await loop.run_in_executor(writer, open, filepath, 'wb')
+        try:
+            chunk = bytearray()
+            # Take whatever has been buffered from the socket, rather than re-slicing it into fixed chunks.
+            async for data in response.content.iter_any():
+                chunk += data
+                if len(chunk) >= args.chunk_size:
+                    await loop.run_in_executor(writer, file.write, chunk)
+                    chunk = bytearray()
+
+            if len(chunk) > 0:
+                await loop.run_in_executor(writer, file.write, chunk)
+        finally:
+            await loop.run_in_executor(writer, file.close)
+
+async def download_worker(session, writer, queue, seen_urls, progress):
+    """
+    Download images from the queue until None is received.
+    Returns the number of failed downloads.
+    """
+    failed_downloads = 0
+    while True:
+        url = await queue.get()
+        if url is None: break
+        # The same image may be found on multiple pages or sources.
+        if url in seen_urls: continue
+        seen_urls.add(url)
+
+        try:
+            await download_image(session, writer, url)
+        except Exception:
+            failed_downloads += 1
+
+        progress.update(1)
+
+    return failed_downloads
 
 # Map each source to a function
 _SOURCE_HANDLERS = {
@@ -207,21 +358,48 @@ _SOURCE_HANDLERS = {
     WalmartSource.WALMART_COM: scrape_walmart_com
 }
 
-result = set()
-for source in args.sources:
-    source_name = 'Walmart.' + source.value
-    print(f'Scraping "{args.query}" from {source_name}')
-    result.update(_SOURCE_HANDLERS[source]())
+async def scrape_and_download():
+    """
+    Scrape all the sources and download the images as they are found.
+    Returns the number of downloaded and failed images.
+    """
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+
+    def scrape(source):
+        """Scrape a source (on a worker thread) and put the images on the queue."""
+        source_name = 'Walmart.' + source.value
+        print(f'Scraping "{args.query}" from {source_name}')
+        for url in _SOURCE_HANDLERS[source]():
+            loop.call_soon_threadsafe(queue.put_nowait, url)
+
+    connector = aiohttp.TCPConnector(limit=args.max_concurrent_downloads, limit_per_host=16)
+    async with aiohttp.ClientSession(connector=connector, headers={'User-Agent': USER_AGENT}) as session:
+        # Images are written to disk by a dedicated pool of threads.
+        with ThreadPoolExecutor(max_workers=2) as writer, tqdm.tqdm(desc='Downloading', unit='image') as progress:
+            # The scrapers (producers) and the downloaders (consumers) run concurrently.
+            seen_urls = set()
+            workers = [asyncio.ensure_future(download_worker(session, writer, queue, seen_urls, progress))
+                for _ in range(args.max_concurrent_downloads)
+            ]
+
+            try:
+                await asyncio.gather(*(loop.run_in_executor(None, scrape, source) for source in args.sources))
+            finally:
+                # Signal the downloaders to stop once the queue has been drained.
+                for _ in workers:
+                    queue.put_nowait(None)
+
+                failed_downloads = sum(await asyncio.gather(*workers))
+
+    return len(seen_urls), failed_downloads
 
-# Download images
 print(f'Downloading and saving images to {args.output_directory}')
 args.output_directory.mkdir(parents=True, exist_ok=True)
 
-for url in tqdm.tqdm(result):
-    response = requests.get(url, stream=True)
-    extension = mimetypes.guess_extension(response.headers['content-type'])
-    filepath = args.output_directory / f'{uuid.uuid4()}{extension}'
-    with open(filepath, 'wb+') as file:
-        for chunk in response.iter_content(args.chunk_size):
-            if not chunk: break
-            file.write(chunk)
\ No newline at end of file
+# Load the mimetypes database up front rather than lazily on the first lookup.
+mimetypes.init()
+
+total_images, failed_downloads = asyncio.run(scrape_and_download())
+if failed_downloads > 0:
+    print(f'Failed to download {failed_downloads} (out of {total_images}) images.')
\ No newline at end of file
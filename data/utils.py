@@ -1,7 +1,15 @@
 """Utility functions."""
 
+import os
+import re
+import cv2
+import time
 import shutil
+import fnmatch
+import hashlib
 import argparse
+import numpy as np
+from pathlib import Path
 
 class ReadableDirectory(argparse.Action):
     """Makes sure that a directory argument is a valid path and readable."""
@@ -14,13 +22,79 @@ class ReadableDirectory(argparse.Action):
 
         setattr(namespace, self.dest, value)
 
+def scandir_files(directory):
+    """
+    Recursively yield the path (as a string) of every file in the given directory.
+
+    This uses `os.scandir`, which avoids creating a `Path` object and calling `stat`
+    for every entry (the file type is usually known from the directory listing).
+    """
+    stack = [str(directory)]
+    while len(stack) > 0:
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.is_file():
+                    yield entry.path
+
 def get_files(source, patterns):
     """Get all the paths matching the given list of glob patterns."""
 
-    for pattern in patterns:
-        files = source.glob(f'**/{pattern}')
-        for file in files:
-            yield file
+    if len(patterns) == 0: return
+
+    # Match all the patterns at once with a single regex (normalizing case the same as `fnmatch.fnmatch`).
+    pattern = re.compile('|'.join(fnmatch.translate(os.path.normcase(pattern)) for pattern in patterns))
+    for filepath in scandir_files(source):
+        filename = os.path.normcase(os.path.basename(filepath))
+        if pattern.match(filename):
+            yield Path(filepath)
+
+def read_image(filepath, flags=cv2.IMREAD_COLOR):
+    """
+    Read an image with OpenCV.
+
+    :param filepath:
+        The path to the image file.
+    :param flags:
+        The flags to decode the image with. Defaults to `cv2.IMREAD_COLOR`.
+    :returns:
+        The decoded image, or None if the file is not an image. Raises an
+        `OSError` (e.g. `FileNotFoundError`) if the file could not be read.
+    """
+
+    # Decoding from a buffer (rather than with cv2.imread) avoids issues with non-ASCII filepaths.
+    # OpenCV releases the GIL while decoding, so this parallelizes over threads.
+    buffer = np.fromfile(str(filepath), dtype=np.uint8)
+    if buffer.size == 0: return None
+    return cv2.imdecode(buffer, flags)
+
+def get_md5_from_file(filepath, chunk_size=1 << 20):
+    """
+    Gets the MD5 hash of a file.
+
+    :param filepath:
+        The path to the file.
+    :param chunk_size:
+        An integer representing the number of bytes of data to get
+        in a single iteration. Only used on Python versions without
+        `hashlib.file_digest`. Defaults to 1 MiB.
+    :returns:
+        The MD5 hash of the file, or None if it doesn't exist.
+    """
+
+    if not filepath.exists(): return
+
+    with open(filepath, 'rb') as file:
+        # Python 3.11+ reads and hashes the file entirely in C.
+        if hasattr(hashlib, 'file_digest'):
+            return hashlib.file_digest(file, 'md5').hexdigest()
+
+        h = hashlib.md5()
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            h.update(chunk)
+
+    return h.hexdigest()
 
 def rmtree(path, ignore_errors=False, onerror=None, timeout=10):
     """
@@ -32,7 +106,12 @@ def rmtree(path, ignore_errors=False, onerror=None, timeout=10):
     if path.is_dir():
         print(f'shutil.rmtree - Waiting for \'{path}\' to be removed...')
         # The destination path has yet to be deleted. Wait, at most, the timeout period.
+        # Poll with an exponential backoff rather than spinning on `is_dir`.
         timeout_time = time.time() + timeout
+        delay = 0.01
         while time.time() <= timeout_time:
             if not path.is_dir():
-                break
\ No newline at end of file
+                return
+
+            time.sleep(delay)
+            delay = min(delay * 2, 0.5)
\ No newline at end of file